@@ -1,10 +1,52 @@
 import streamlit as st
 import os
+import logging
+import contextlib
 from dotenv import load_dotenv
-from supabase import create_client
+from supabase import create_client, create_async_client
 from assets import MODELS_USED
 
 load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Tables created from older versions of the README lack the UNIQUE constraint
+# that every upsert on unique_name relies on
+UNIQUE_NAME_MIGRATION = "ALTER TABLE scraped_data ADD CONSTRAINT scraped_data_unique_name_key UNIQUE (unique_name);"
+
+class MissingUniqueConstraintError(RuntimeError):
+    """Raised when scraped_data has no UNIQUE constraint on unique_name."""
+
+def check_unique_constraint_error(error):
+    """
+    Re-raises a PostgREST error as MissingUniqueConstraintError when the
+    upsert failed because ON CONFLICT (unique_name) has no matching
+    constraint (Postgres error 42P10); any other error is left alone.
+    """
+    if getattr(error, "code", None) == "42P10":
+        raise MissingUniqueConstraintError(
+            f"The scraped_data table has no UNIQUE constraint on unique_name. Run this in the Supabase SQL Editor:\n{UNIQUE_NAME_MIGRATION}"
+        ) from error
+
+async def upsert_scraped_data_async(db, rows, label):
+    """
+    Upsert rows into scraped_data with a single request, keyed on unique_name,
+    using the async supabase client. label names the column for the logs.
+    A failed upsert is logged, not raised: the LLM calls behind these rows
+    have already been paid for, so the caller still returns its results.
+    Only MissingUniqueConstraintError propagates, since every write would fail.
+    """
+    if not rows:
+        return
+    try:
+        await db.table("scraped_data").upsert(rows, on_conflict="unique_name").execute()
+    except Exception as e:
+        check_unique_constraint_error(e)
+        logger.error("Error saving %s for %s: %s", label, ", ".join(row["unique_name"] for row in rows), e)
+        return
+    for row in rows:
+        logger.info("%s saved for %s", label, row["unique_name"])
+
 def get_api_key(model):
     """
     Returns an API key for a given model by:
@@ -12,16 +54,70 @@ def get_api_key(model):
          (We assume there's exactly one item in that set.)
       2) Returning the key from st.session_state if present;
          otherwise from os.environ.
+    st.session_state is not reachable from worker threads, so resolve the
+    key on the script thread and pass it along (see call_llm_model's api_key).
     """
     env_var_name = list(MODELS_USED[model])[0]  # e.g., "GEMINI_API_KEY"
     return st.session_state.get(env_var_name) or os.getenv(env_var_name)
 
-def get_supabase_client():
-    """Returns a Supabase client if credentials exist, otherwise shows a guide."""
+def _get_supabase_credentials():
+    """Returns (url, key) from session or OS, or None if they are missing."""
     supabase_url = st.session_state.get('SUPABASE_URL') or os.getenv('SUPABASE_URL')
     supabase_key = st.session_state.get('SUPABASE_ANON_KEY') or os.getenv('SUPABASE_ANON_KEY')
 
     if not supabase_url or not supabase_key or "your-supabase-url-here" in supabase_url:
         return None
+    return supabase_url, supabase_key
+
+def get_supabase_client():
+    """Returns a Supabase client if credentials exist, otherwise shows a guide."""
+    credentials = _get_supabase_credentials()
+    if credentials is None:
+        return None
 
+    return create_client(*credentials)
+
+@st.cache_resource(show_spinner=False)
+def _create_cached_supabase_client(supabase_url, supabase_key):
     return create_client(supabase_url, supabase_key)
+
+def get_cached_supabase_client():
+    """
+    Same as get_supabase_client(), but the client is built once per set of
+    credentials and reused across reruns and sessions.
+    Missing credentials are not cached, so the client appears as soon as
+    they are entered.
+    """
+    credentials = _get_supabase_credentials()
+    if credentials is None:
+        return None
+
+    return _create_cached_supabase_client(*credentials)
+
+def clear_cached_supabase_client():
+    """Drops the cached client so the next call reconnects."""
+    _create_cached_supabase_client.clear()
+
+async def get_async_supabase_client():
+    """
+    Returns an async Supabase client if credentials exist, otherwise None.
+    The client is bound to the running event loop, so create one per run.
+    """
+    credentials = _get_supabase_credentials()
+    if credentials is None:
+        return None
+
+    return await create_async_client(*credentials)
+
+@contextlib.asynccontextmanager
+async def async_supabase_client():
+    """
+    get_async_supabase_client() for the duration of one pipeline run:
+    the client's connections are closed on exit, before its event loop is.
+    """
+    db = await get_async_supabase_client()
+    try:
+        yield db
+    finally:
+        if db is not None:
+            await db.postgrest.aclose()
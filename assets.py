@@ -10,14 +10,36 @@ MODELS_USED = {
     OPENAI_MODEL_FULLNAME: {"OPENAI_API_KEY"},
     GEMINI_MODEL_FULLNAME: {"GEMINI_API_KEY"},
 }
+# Every API key name needed by MODELS_USED, once each (models may share a key)
+API_KEY_NAMES = tuple(sorted({key for keys in MODELS_USED.values() for key in keys}))
 # Timeout settings for web scraping
 TIMEOUT_SETTINGS = {
-    "page_load": 30,
-    "script": 10
+    "page_load": 60,  # same as crawl4ai's default page timeout
+    "page_load_fast": 15,  # first attempt; only timeouts are retried with page_load
+    "script": 10,
+    "revalidate": 5
 }
 
 NUMBER_SCROLL=2
 
+# Number of rows sent to Supabase in a single request
+SUPABASE_BATCH_SIZE=100
+
+# LLM requests sent concurrently, and retries on rate-limit (429) errors
+MAX_CONCURRENT_LLM_CALLS=8
+LLM_MAX_RETRIES=3
+
+# Multi-page extraction: max pages per LLM call (sidebar slider upper bound)
+# and tokens kept free for the answer when packing pages into one prompt
+MAX_PAGES_PER_LLM_CALL=16
+BATCH_RESPONSE_TOKENS=8000
+
+# Pages fetched at once: open HEAD connections and browser pages in crawl4ai
+MAX_CONCURRENT_FETCHES=20
+
+# Rows sent to the browser per page of the results preview
+PREVIEW_ROWS=500
+
 
 
 
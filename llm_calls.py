@@ -1,14 +1,72 @@
 # llm_calls.py
 import litellm
-import json
-from litellm import (completion,token_counter,completion_cost,get_max_tokens,)
-from assets import USER_MESSAGE, MODELS_USED
-from api_management import get_api_key
-import os
+import orjson
+from litellm import (completion,token_counter,completion_cost,cost_per_token,get_max_tokens,)
+from assets import USER_MESSAGE, LLM_MAX_RETRIES
+import time
 
 
+def get_input_token_budget(model, reserved_output_tokens):
+    """
+    Returns how many prompt tokens the model accepts while still leaving
+    reserved_output_tokens for its answer.
+    """
+    max_input_tokens = litellm.get_model_info(model).get("max_input_tokens") or get_max_tokens(model)
+    return max_input_tokens - reserved_output_tokens
 
-def call_llm_model(data,response_format,model,system_message,extra_user_instruction="",max_tokens=None,use_model_max_tokens_if_none=False):
+def read_stream_until_json_complete(response):
+    """
+    Reads a streamed completion only until its first top-level JSON value
+    (object or array) is closed (bracket depth back to zero; brackets inside
+    strings are ignored), then closes the stream so the model stops
+    generating trailing text.
+
+    Returns the text from the opening "{" or "[" to its matching bracket,
+    or everything received if no complete value was streamed.
+    """
+    pieces = []
+    offset = 0
+    start = end = None
+    depth = 0
+    in_string = escaped = False
+
+    for chunk in response:
+        piece = chunk.choices[0].delta.content or ""
+        for i, char in enumerate(piece):
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif char == "\\":
+                    escaped = True
+                elif char == '"':
+                    in_string = False
+            elif start is None:
+                if char in "{[":
+                    start = offset + i
+                    depth = 1
+            elif char == '"':
+                in_string = True
+            elif char in "{[":
+                depth += 1
+            elif char in "}]":
+                depth -= 1
+                if depth == 0:
+                    end = offset + i + 1
+                    break
+        pieces.append(piece)
+        offset += len(piece)
+        if end is not None:
+            break
+
+    # Stop the provider from generating (and billing) the rest of the answer
+    stream = getattr(response, "completion_stream", None)
+    if hasattr(stream, "close"):
+        stream.close()
+
+    text = "".join(pieces)
+    return text[start:end] if end is not None else text
+
+def call_llm_model(data,response_format,model,system_message,extra_user_instruction="",max_tokens=None,use_model_max_tokens_if_none=False,stream=False,api_key=None):
     """
     Calls an LLM via LiteLLM and returns:
       - parsed_response (str or dict, depending on your response_format),
@@ -27,6 +85,12 @@ def call_llm_model(data,response_format,model,system_message,extra_user_instruct
         max_tokens (int, optional): The maximum number of tokens to allow in the completion.
         use_model_max_tokens_if_none (bool, optional): If True and max_tokens is not provided,
             the function will automatically use the model's maximum context size.
+        stream (bool, optional): If True, the completion is streamed and reading stops as
+            soon as the first JSON object is complete (see read_stream_until_json_complete).
+            The cost is then computed from the counted tokens.
+        api_key (str, optional): Key sent with this request only (see api_management.get_api_key).
+            Resolve it on the script thread: worker threads can't read st.session_state.
+            Without it, litellm falls back to the provider's environment variable.
 
     Returns:
         tuple: (parsed_response, token_counts, cost)
@@ -34,15 +98,6 @@ def call_llm_model(data,response_format,model,system_message,extra_user_instruct
             - token_counts: A dict with "input_tokens" and "output_tokens".
             - cost: The overall cost (in USD) for the API call.
     """
-    # 1) Retrieve the single API key name for this model from MODELS_USED
-    env_var_name = list(MODELS_USED[model])[0]  # e.g., "GEMINI_API_KEY"
-    # 2) Retrieve the actual key from session or OS
-    env_value = get_api_key(model)
-    print("env variable is:" + env_value)
-    # 3) Set it in os.environ so that litellm / underlying client sees it
-    if env_value:
-        os.environ[env_var_name] = env_value
-
     model_max_tokens = get_max_tokens(model)
     if max_tokens is not None:
         max_tokens = min(max_tokens, model_max_tokens)-100 
@@ -63,12 +118,20 @@ def call_llm_model(data,response_format,model,system_message,extra_user_instruct
     }
     if max_tokens is not None:
         params["max_tokens"] = max_tokens
+    if stream:
+        params["stream"] = True
+    if api_key:
+        # per request, never os.environ: sessions with different keys share the process
+        params["api_key"] = api_key
 
     # Call the LLM using LiteLLM
     response = completion(**params)
 
     # Extract the parsed response
-    parsed_response = response.choices[0].message.content
+    if stream:
+        parsed_response = read_stream_until_json_complete(response)
+    else:
+        parsed_response = response.choices[0].message.content
 
     # Calculate token counts:
     #   - input_tokens: from the user/system prompt
@@ -78,7 +141,7 @@ def call_llm_model(data,response_format,model,system_message,extra_user_instruct
     # Make sure we convert the parsed response to a string for counting
     output_text = (
         parsed_response if isinstance(parsed_response, str)
-        else json.dumps(parsed_response)
+        else orjson.dumps(parsed_response).decode()
     )
     output_tokens = token_counter(model=model, text=output_text)
 
@@ -88,7 +151,25 @@ def call_llm_model(data,response_format,model,system_message,extra_user_instruct
     }
 
     # Calculate the total cost for the request
-    cost = completion_cost(completion_response=response)
+    if stream:
+        # There is no final response object to price when the stream is cut short
+        prompt_cost, completion_cost_usd = cost_per_token(model=model, prompt_tokens=input_tokens, completion_tokens=output_tokens)
+        cost = prompt_cost + completion_cost_usd
+    else:
+        cost = completion_cost(completion_response=response)
 
     return parsed_response, token_counts, cost
 
+
+def call_llm_model_with_retry(*args, max_retries=LLM_MAX_RETRIES, **kwargs):
+    """
+    Same as call_llm_model(), but retries with exponential backoff
+    (1s, 2s, 4s, ...) when the provider answers with a rate-limit error (HTTP 429).
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return call_llm_model(*args, **kwargs)
+        except litellm.RateLimitError:
+            if attempt == max_retries:
+                raise
+            time.sleep(2 ** attempt)
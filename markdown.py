@@ -1,43 +1,215 @@
 # markdown.py
 
 import asyncio
-from typing import List
-from api_management import get_supabase_client
-from utils import generate_unique_name
-from crawl4ai import AsyncWebCrawler
+import atexit
+import functools
+import logging
+import threading
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
+import diskcache
+import httpx
+from api_management import get_cached_supabase_client, check_unique_constraint_error
+from assets import SUPABASE_BATCH_SIZE, TIMEOUT_SETTINGS, MAX_CONCURRENT_FETCHES
+from utils import generate_unique_names
+from crawl4ai import AsyncWebCrawler, CrawlerRunConfig
+
+logger = logging.getLogger(__name__)
+
+# Local cache of crawled pages: {url: (etag, last_modified, markdown)}.
+# Entries are only reused after a HEAD request confirms the page is unchanged.
+markdown_cache = diskcache.Cache(".markdown_cache")
+
+# A single event loop running in a background thread owns the shared crawler,
+# so the browser is launched once per process instead of once per call.
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+_crawler_task: Optional["asyncio.Task[AsyncWebCrawler]"] = None
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    """Return the background event loop, starting it on first use."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="crawler-loop", daemon=True).start()
+    return _loop
+
+
+def _run(coro):
+    """Run a coroutine on the background loop and block until it returns."""
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop()).result()
+
+
+async def _start_crawler() -> AsyncWebCrawler:
+    crawler = AsyncWebCrawler()
+    await crawler.start()
+    return crawler
+
+
+async def _get_crawler() -> AsyncWebCrawler:
+    """
+    Return the shared AsyncWebCrawler, starting it on first use.
+    Must be awaited on the background loop.
+    """
+    global _crawler_task
+    if _crawler_task is None:
+        _crawler_task = asyncio.ensure_future(_start_crawler())
+    try:
+        return await _crawler_task
+    except Exception:
+        _crawler_task = None  # let the next call retry the browser launch
+        raise
+
+
+async def _discard_crawler(crawler: AsyncWebCrawler) -> None:
+    """
+    Forget a crawler whose browser is gone, so the next _get_crawler()
+    launches a new one. Closing the dead browser is best effort.
+    """
+    global _crawler_task
+    _crawler_task = None
+    try:
+        await crawler.close()
+    except Exception as e:
+        logger.debug("Error closing the dead crawler: %s", e)
+
+
+@atexit.register
+def _close_crawler() -> None:
+    if _loop is None:
+        return
+    if _crawler_task is not None and _crawler_task.done() and not _crawler_task.exception():
+        asyncio.run_coroutine_threadsafe(_crawler_task.result().close(), _loop).result(timeout=10)
+    _loop.call_soon_threadsafe(_loop.stop)
 
-supabase = get_supabase_client()
 
 async def get_fit_markdown_async(url: str) -> str:
     """
     Async function using crawl4ai's AsyncWebCrawler to produce the regular raw markdown.
     (Reverting from the 'fit' approach back to normal.)
+    It uses the shared crawler, so it only works when awaited on the
+    background loop: from anywhere else, call fetch_fit_markdown().
     """
-
-    async with AsyncWebCrawler() as crawler:
-        result = await crawler.arun(url=url)
-        if result.success:
-            return result.markdown
-        else:
-            return ""
+    markdowns = await fetch_many_async([url], TIMEOUT_SETTINGS)
+    return markdowns[url]
 
 
 def fetch_fit_markdown(url: str) -> str:
     """
-    Synchronous wrapper around get_fit_markdown_async().
+    Synchronous wrapper around get_fit_markdown_async(), run on the
+    background loop that owns the shared crawler.
+    """
+    return _run(get_fit_markdown_async(url))
+
+@functools.lru_cache(maxsize=8)
+def _build_run_config(timeout_items: FrozenSet[Tuple[str, int]], concurrency: int = MAX_CONCURRENT_FETCHES) -> CrawlerRunConfig:
+    """
+    Build the crawl4ai run config for a set of timeout settings
+    (frozen TIMEOUT_SETTINGS items, so identical settings share one config).
+    arun_many() keeps at most `concurrency` pages open at once.
+    """
+    timeout_settings = dict(timeout_items)
+    return CrawlerRunConfig(page_timeout=timeout_settings["page_load"] * 1000, semaphore_count=concurrency)
+
+async def _head_validators(client: httpx.AsyncClient, url: str) -> Tuple[str, str]:
+    """
+    HEAD the URL and return its (ETag, Last-Modified) headers.
+    Missing headers, error statuses and network errors all give "".
     """
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
     try:
-        return loop.run_until_complete(get_fit_markdown_async(url))
-    finally:
-        loop.close()
+        response = await client.head(url, follow_redirects=True)
+    except httpx.HTTPError:
+        return "", ""
+    if not response.is_success:
+        return "", ""
+    return response.headers.get("etag", ""), response.headers.get("last-modified", "")
+
+def _is_timeout(result) -> bool:
+    return "timeout" in (result.error_message or "").lower()
+
+# Playwright errors seen when Chromium crashed or the connection to it dropped
+_BROWSER_GONE_MARKERS = ("has been closed", "browser closed", "connection closed", "disconnected")
+
+def _is_browser_gone(result) -> bool:
+    error = (result.error_message or "").lower()
+    return any(marker in error for marker in _BROWSER_GONE_MARKERS)
+
+async def _arun_many_with_adaptive_timeout(crawler: AsyncWebCrawler, urls: List[str], timeout_settings: dict, concurrency: int = MAX_CONCURRENT_FETCHES) -> list:
+    """
+    Crawl every URL with the short "page_load_fast" timeout first, then retry
+    only the navigation timeouts with the full "page_load" timeout.
+    Failing sites release their crawl slot quickly instead of holding it
+    for the whole page_load budget.
+    """
+    fast_settings = {**timeout_settings, "page_load": timeout_settings["page_load_fast"]}
+    results = await crawler.arun_many(urls=urls, config=_build_run_config(frozenset(fast_settings.items()), concurrency))
+
+    slow_lane = [result.url for result in results if not result.success and _is_timeout(result)]
+    if not slow_lane:
+        return results
+    retried = await crawler.arun_many(urls=slow_lane, config=_build_run_config(frozenset(timeout_settings.items()), concurrency))
+    return [result for result in results if result.url not in slow_lane] + list(retried)
+
+async def fetch_many_async(urls: List[str], timeout_settings: dict, concurrency: int = MAX_CONCURRENT_FETCHES) -> Dict[str, str]:
+    """
+    Crawl several URLs concurrently with crawl4ai's arun_many() using the
+    shared AsyncWebCrawler. Must be awaited on the background loop.
+    At most `concurrency` HEAD requests and browser pages are open at once.
+    Pages whose ETag/Last-Modified match markdown_cache are served from the
+    cache without crawling; the rest go through the fast/slow timeout lanes.
+    If the shared browser died, it is relaunched and those pages crawled once more.
+    Returns {url: markdown}; failed crawls map to "".
+    """
+    markdowns = {url: "" for url in urls}
+    if not urls:
+        return markdowns
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=timeout_settings["revalidate"], limits=limits) as client:
+        validators = dict(zip(urls, await asyncio.gather(*(_head_validators(client, url) for url in urls))))
+
+    to_crawl = []
+    for url in urls:
+        etag, last_modified = validators[url]
+        cached = markdown_cache.get(url)
+        if cached and (etag or last_modified) and cached[:2] == (etag, last_modified):
+            markdowns[url] = cached[2]
+        else:
+            to_crawl.append(url)
+    if not to_crawl:
+        return markdowns
+
+    crawler = await _get_crawler()
+    try:
+        results = await _arun_many_with_adaptive_timeout(crawler, to_crawl, timeout_settings, concurrency)
+        retry = [result.url for result in results if not result.success and _is_browser_gone(result)]
+    except Exception as e:
+        logger.warning("Crawl failed, relaunching the browser: %s", e)
+        results, retry = [], to_crawl
+    if retry:
+        # The shared browser crashed or disconnected: relaunch it once and
+        # crawl again the pages that failed because of it
+        logger.warning("Browser is gone, relaunching it for %d pages", len(retry))
+        await _discard_crawler(crawler)
+        crawler = await _get_crawler()
+        retried = await _arun_many_with_adaptive_timeout(crawler, retry, timeout_settings, concurrency)
+        results = [result for result in results if result.url not in retry] + list(retried)
+
+    for result in results:
+        if result.success:
+            markdowns[result.url] = result.markdown
+            etag, last_modified = validators.get(result.url, ("", ""))
+            if etag or last_modified:
+                markdown_cache.set(result.url, (etag, last_modified, str(result.markdown)))
+    return markdowns
 
 def read_raw_data(unique_name: str) -> dict:
     """
     Query the 'scraped_data' table for the row with this unique_name,
     and return a dictionary containing 'raw_data' and 'url' fields.
     """
+    supabase = get_cached_supabase_client()
     response = supabase.table("scraped_data").select("raw_data,url").eq("unique_name", unique_name).execute()
     data = response.data
     if data and len(data) > 0:
@@ -50,44 +222,107 @@ def read_raw_data(unique_name: str) -> dict:
         "url": ""
     }
 
-def save_raw_data(unique_name: str, url: str, raw_data: str) -> None:
+def read_raw_data_many(unique_names: List[str]) -> Dict[str, dict]:
+    """
+    Batched version of read_raw_data(): one SELECT per SUPABASE_BATCH_SIZE
+    unique_names instead of one per row.
+    Returns {unique_name: {"content": ..., "url": ...}} for the rows that exist.
+    """
+    supabase = get_cached_supabase_client()
+    rows = {}
+    for start in range(0, len(unique_names), SUPABASE_BATCH_SIZE):
+        chunk = unique_names[start:start + SUPABASE_BATCH_SIZE]
+        response = supabase.table("scraped_data").select("unique_name,raw_data,url").in_("unique_name", chunk).execute()
+        for row in response.data or []:
+            rows[row["unique_name"]] = {
+                "content": row["raw_data"],
+                "url": row.get("url", "")
+            }
+    return rows
+
+async def read_raw_data_many_async(db, unique_names: List[str]) -> Dict[str, dict]:
+    """
+    read_raw_data_many() through an async supabase client (db), so the
+    event loop keeps running the other pipeline steps while rows arrive.
+    """
+    rows = {}
+    for start in range(0, len(unique_names), SUPABASE_BATCH_SIZE):
+        chunk = unique_names[start:start + SUPABASE_BATCH_SIZE]
+        response = await db.table("scraped_data").select("unique_name,raw_data,url").in_("unique_name", chunk).execute()
+        for row in response.data or []:
+            rows[row["unique_name"]] = {
+                "content": row["raw_data"],
+                "url": row.get("url", "")
+            }
+    return rows
+
+def find_stored_unique_names(unique_names: List[str]) -> Set[str]:
     """
-    Save or update the row in supabase with unique_name, url, and raw_data.
-    If a row with unique_name doesn't exist, it inserts; otherwise it might upsert.
+    Return the subset of unique_names that already have non-empty raw_data.
+    Only the unique_name column is selected, so the stored markdown
+    never crosses the network just to be checked.
     """
-    supabase.table("scraped_data").upsert({
-        "unique_name": unique_name,
-        "url": url,
-        "raw_data": raw_data
-    }, on_conflict="id").execute()
-    BLUE = "\033[34m"
-    RESET = "\033[0m"
-    print(f"{BLUE}INFO:Raw data stored for {unique_name}{RESET}")
+    supabase = get_cached_supabase_client()
+    stored = set()
+    for start in range(0, len(unique_names), SUPABASE_BATCH_SIZE):
+        chunk = unique_names[start:start + SUPABASE_BATCH_SIZE]
+        # neq '""' also filters out NULL raw_data
+        response = supabase.table("scraped_data").select("unique_name").in_("unique_name", chunk).neq("raw_data", '""').execute()
+        stored.update(row["unique_name"] for row in response.data or [])
+    return stored
 
-def fetch_and_store_markdowns(urls: List[str]) -> List[str]:
+def save_raw_data_batch(rows: List[dict]) -> None:
+    """
+    Upsert several rows ({"unique_name", "url", "raw_data"}) into supabase
+    with a single request, keyed on unique_name.
+    Raises MissingUniqueConstraintError on tables without UNIQUE (unique_name).
+    """
+    if not rows:
+        return
+    supabase = get_cached_supabase_client()
+    try:
+        supabase.table("scraped_data").upsert(rows, on_conflict="unique_name").execute()
+    except Exception as e:
+        check_unique_constraint_error(e)
+        raise
+    for row in rows:
+        logger.info("Raw data stored for %s", row["unique_name"])
+
+def fetch_and_store_markdowns(urls: List[str], concurrency: int = MAX_CONCURRENT_FETCHES) -> List[str]:
     """
     For each URL:
       1) Generate unique_name
       2) Check if there's already a row in supabase with that unique_name
-      3) If not found or if raw_data is empty, fetch fit_markdown
-      4) Save to supabase
-    Return a list of unique_names (one per URL).
+      3) Crawl all URLs that are not found or whose raw_data is empty,
+         concurrently in the shared browser (at most `concurrency` at once)
+      4) Save to supabase, SUPABASE_BATCH_SIZE rows per request
+         (a single upsert for up to SUPABASE_BATCH_SIZE URLs; there is no
+         per-URL write, so callers should pass all their URLs at once)
+    Duplicate URLs are only processed once and share a unique_name.
+    Return a list of unique_names (one per URL, in the order given).
     """
-    unique_names = []
+    unique_urls = list(dict.fromkeys(urls))
+    url_to_name = dict(zip(unique_urls, generate_unique_names(unique_urls)))
+    unique_names = list(url_to_name.values())
 
-    for url in urls:
-        unique_name = generate_unique_name(url)
-        MAGENTA = "\033[35m"
-        RESET = "\033[0m"
-        # check if we already have raw_data in supabase
-        raw_data = read_raw_data(unique_name)
-        if raw_data and raw_data.get("content"):  # Check if there's actual content
-            print(f"{MAGENTA}Found existing data in supabase for {url} => {unique_name}{RESET}")
+    # check which unique_names already have raw_data in supabase, in one go
+    stored = find_stored_unique_names(unique_names)
+    missing = []
+    for url, unique_name in url_to_name.items():
+        if unique_name in stored:
+            logger.info("Found existing data in supabase for %s => %s", url, unique_name)
         else:
-            # fetch fit markdown
-            fit_md = fetch_fit_markdown(url)
-            print(fit_md)
-            save_raw_data(unique_name, url, fit_md)
-        unique_names.append(unique_name)
+            missing.append((url, unique_name))
+
+    # fetch fit markdown for every missing URL at once
+    markdowns = _run(fetch_many_async([url for url, _ in missing], TIMEOUT_SETTINGS, concurrency))
+
+    rows = []
+    for url, unique_name in missing:
+        fit_md = markdowns[url]
+        logger.debug("fit_md len=%d for %s", len(fit_md), url)
+        rows.append({"unique_name": unique_name, "url": url, "raw_data": fit_md})
+    for start in range(0, len(rows), SUPABASE_BATCH_SIZE):
+        save_raw_data_batch(rows[start:start + SUPABASE_BATCH_SIZE])
 
-    return unique_names
+    return [url_to_name[url] for url in urls]
@@ -1,16 +1,26 @@
 # pagination.py
 
-import json
-from typing import List, Dict
-from assets import PROMPT_PAGINATION
-from markdown import read_raw_data
-from api_management import get_supabase_client
+import asyncio
+import logging
+import re
+from typing import List, Dict, Optional
+from assets import PROMPT_PAGINATION, SUPABASE_BATCH_SIZE, MAX_CONCURRENT_LLM_CALLS
+from markdown import read_raw_data_many_async
+from api_management import get_api_key, async_supabase_client, upsert_scraped_data_async
+from utils import to_jsonb
 from pydantic import BaseModel, Field
 from typing import List
 from pydantic import create_model
-from llm_calls import (call_llm_model)
+from llm_calls import call_llm_model_with_retry
 
-supabase = get_supabase_client()
+logger = logging.getLogger(__name__)
+
+# URL shapes whose page number we can bump without asking the LLM
+_PAGE_NUMBER_PATTERNS = (
+    re.compile(r"[?&]page=(\d+)"),
+    re.compile(r"/page/(\d+)(?=/|$)"),
+    re.compile(r"&p=(\d+)"),
+)
 
 
 class PaginationModel(BaseModel):
@@ -42,53 +52,114 @@ def build_pagination_prompt(indications: str, url: str) -> str:
     return prompt
 
 
-def save_pagination_data(unique_name: str, pagination_data):
-       # if it's a pydantic object, convert to dict
-    if hasattr(pagination_data, "dict"):
-        pagination_data = pagination_data.dict()
-    
-    # parse if string
-    if isinstance(pagination_data, str):
-        try:
-            pagination_data = json.loads(pagination_data)
-        except json.JSONDecodeError:
-            pagination_data = {"raw_text": pagination_data}
-
-    supabase.table("scraped_data").update({
-        "pagination_data": pagination_data
-    }).eq("unique_name", unique_name).execute()
-    MAGENTA = "\033[35m"
-    RESET = "\033[0m" 
-    print(f"{MAGENTA}INFO:Pagination data saved for {unique_name}{RESET}")
-
-def paginate_urls(unique_names: List[str], selected_model: str, indication: str, urls:List[str]):
+async def save_pagination_data_batch_async(db, rows: List[Dict]) -> None:
+    """
+    Upsert pagination_data for several unique_names with a single request.
+    Each row is {"unique_name": str, "pagination_data": str | dict | pydantic model}.
+    """
+    # pydantic object -> dict, JSON string -> parsed once
+    payload = [
+        {"unique_name": row["unique_name"], "pagination_data": to_jsonb(row["pagination_data"])}
+        for row in rows
+    ]
+    await upsert_scraped_data_async(db, payload, "pagination_data")
+
+def try_regex_pagination(urls: List[str]) -> Optional[List[Dict]]:
     """
-    For each unique_name, read raw_data, detect pagination, save results,
-    accumulate cost usage, and return a final summary.
+    Cheap pagination for URLs that carry their page number.
+    1) Match each URL against ?page=N, /page/N/ and &p=N.
+    2) Build the next page URL by replacing N with N+1.
+    Returns one {"page_urls": [next_url]} per URL, or None as soon as a URL
+    has no page number, so the caller can fall back to the LLM.
+    Unlike the LLM, this only gives the next page, not the full page list.
+    """
+    if not urls:
+        return None
+    pages = []
+    for url in urls:
+        for pattern in _PAGE_NUMBER_PATTERNS:
+            match = pattern.search(url)
+            if match:
+                break
+        else:
+            return None
+        next_url = url[:match.start(1)] + str(int(match.group(1)) + 1) + url[match.end(1):]
+        pages.append({"page_urls": [next_url]})
+    return pages
+
+async def save_regex_pagination_async(db, unique_names: List[str], regex_pages: List[Dict]):
+    """
+    Store the pages found by try_regex_pagination() and return the same
+    summary as paginate_urls_async(), with zero tokens and zero cost.
+    """
+    pagination_results = [
+        {"unique_name": uniq, "pagination_data": page_data}
+        for uniq, page_data in dict(zip(unique_names, regex_pages)).items()
+    ]
+    await _store_pagination_results(db, pagination_results)
+    return 0, 0, 0, pagination_results
+
+async def _store_pagination_results(db, pagination_results: List[Dict]) -> None:
+    for start in range(0, len(pagination_results), SUPABASE_BATCH_SIZE):
+        await save_pagination_data_batch_async(db, pagination_results[start:start + SUPABASE_BATCH_SIZE])
+
+async def paginate_urls_async(db, unique_names: List[str], selected_model: str, indication: str, urls:List[str], raw_rows: Optional[Dict[str, dict]] = None, semaphore: Optional[asyncio.Semaphore] = None):
+    """
+    For each unique_name, read raw_data, detect pagination (up to
+    MAX_CONCURRENT_LLM_CALLS LLM requests in flight), save results through
+    db (the run's async supabase client), accumulate cost usage, and
+    return a final summary.
+    raw_rows and semaphore let a caller running extraction at the same time
+    share its raw_data read and its LLM concurrency limit.
     """
     total_input_tokens = 0
     total_output_tokens = 0
     total_cost = 0
     pagination_results = []
 
-    for uniq,current_url in zip(unique_names, urls):
-        raw_data = read_raw_data(uniq)
+    if raw_rows is None:
+        raw_rows = await read_raw_data_many_async(db, unique_names)
+    response_schema=get_pagination_response_format()
+
+    api_key = get_api_key(selected_model)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_LLM_CALLS)
+
+    async def detect(uniq, current_url):
+        raw_data = raw_rows.get(uniq)
         if not raw_data:
-            print(f"No raw_data found for {uniq}, skipping pagination.")
-            continue
-        response_schema=get_pagination_response_format()
+            logger.info("No raw_data found for %s, skipping pagination.", uniq)
+            return None
         full_indication=build_pagination_prompt(indication,current_url)
-        pag_data, token_counts, cost = call_llm_model(raw_data, response_schema,selected_model, full_indication)
+        async with semaphore:
+            return await asyncio.to_thread(call_llm_model_with_retry, raw_data, response_schema, selected_model, full_indication, api_key=api_key)
 
-        # store
-        save_pagination_data(uniq, pag_data)
+    # one request per unique_name, even if a URL was given twice
+    pages = dict(zip(unique_names, urls))
+    responses = await asyncio.gather(*(detect(uniq, current_url) for uniq, current_url in pages.items()))
+
+    for uniq, response in zip(pages, responses):
+        if response is None:
+            continue
+        pag_data, token_counts, cost = response
 
         # accumulate cost
-        
         total_input_tokens += token_counts["input_tokens"]
         total_output_tokens += token_counts["output_tokens"]
         total_cost += cost
 
         pagination_results.append({"unique_name": uniq,"pagination_data": pag_data})
 
+    # store
+    await _store_pagination_results(db, pagination_results)
+
     return total_input_tokens, total_output_tokens, total_cost, pagination_results
+
+def paginate_urls(unique_names: List[str], selected_model: str, indication: str, urls:List[str]):
+    """
+    Synchronous wrapper around paginate_urls_async().
+    """
+    async def run():
+        async with async_supabase_client() as db:
+            return await paginate_urls_async(db, unique_names, selected_model, indication, urls)
+    return asyncio.run(run())
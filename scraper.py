@@ -1,32 +1,86 @@
 # scraper.py
 
-import json
-from typing import List, Dict, Any
-from assets import OPENAI_MODEL_FULLNAME, GEMINI_MODEL_FULLNAME
-from llm_calls import call_llm_model
-from markdown import read_raw_data
-from api_management import get_supabase_client
+import asyncio
+import orjson
+import functools
+import logging
+import hashlib
+import diskcache
+from typing import List, Dict, Any, AsyncIterator, Optional
+from litellm import token_counter
+from assets import OPENAI_MODEL_FULLNAME, GEMINI_MODEL_FULLNAME, SUPABASE_BATCH_SIZE, MAX_CONCURRENT_LLM_CALLS, BATCH_RESPONSE_TOKENS
+from llm_calls import call_llm_model_with_retry, get_input_token_budget
+from markdown import read_raw_data_many_async
+from api_management import get_api_key, async_supabase_client, upsert_scraped_data_async
 
-supabase = get_supabase_client()
+logger = logging.getLogger(__name__)
 
-def save_formatted_data(unique_name: str, formatted_data):
-    if isinstance(formatted_data, str):
+# Raw LLM responses keyed by hash(model, system message, page content), so
+# re-running the same prompt on the same page doesn't pay for the call again
+llm_cache = diskcache.Cache(".llm_cache")
+
+async def save_formatted_data_batch_async(db, rows: List[Dict[str, Any]]) -> None:
+    """
+    Upsert formatted_data for several unique_names with a single request.
+    Each row is {"unique_name": str, "formatted_data": dict}; callers parse
+    the LLM output first (see parse_extraction_response).
+    """
+    await upsert_scraped_data_async(db, rows, "formatted_data")
+
+def clean_json_response(response_text: str) -> str:
+    """
+    Return the JSON text contained in an LLM response.
+    Responses that are already a bare JSON object are returned as is;
+    otherwise the ```json / ``` markdown fence and any text around the
+    outermost braces are stripped.
+    """
+    stripped = response_text.strip()
+    if stripped.startswith("{") and stripped.endswith("}"):
+        return stripped
+
+    # Fences only ever wrap the response, so trim the ends instead of scanning it
+    if stripped.startswith("```json"):
+        stripped = stripped[7:].lstrip()
+    elif stripped.startswith("```"):
+        stripped = stripped[3:].lstrip()
+    if stripped.endswith("```"):
+        stripped = stripped[:-3].rstrip()
+
+    start, end = stripped.find("{"), stripped.rfind("}")
+    if start != -1 and end > start:
+        return stripped[start:end + 1]
+    return stripped
+
+def _load_json_response(response: str):
+    """Parse an LLM text response as JSON, cleaning it if needed; None if it isn't JSON."""
+    try:
+        return orjson.loads(response)
+    except orjson.JSONDecodeError:
         try:
-            data_json = json.loads(formatted_data)
-        except json.JSONDecodeError:
-            data_json = {"raw_text": formatted_data}
-    elif hasattr(formatted_data, "dict"):
-        data_json = formatted_data.dict()
-    else:
-        data_json = formatted_data
-
-    supabase.table("scraped_data").update({
-        "formatted_data": data_json
-    }).eq("unique_name", unique_name).execute()
-    MAGENTA = "\033[35m"
-    RESET = "\033[0m"  # Reset color to default
-    print(f"{MAGENTA}INFO:Scraped data saved for {unique_name}{RESET}")
+            return orjson.loads(clean_json_response(response))
+        except orjson.JSONDecodeError:
+            return None
 
+def parse_extraction_response(response) -> Dict[str, Any]:
+    """
+    Turn an extraction response into a dict in a single pass.
+    Streamed responses are already the bare JSON object, so they are parsed
+    directly; anything else goes through clean_json_response() first.
+    A bare JSON array becomes {"extracted_data": [...]}, and text that still
+    isn't JSON is kept as raw content.
+    """
+    if isinstance(response, dict):
+        return response
+    response = response or ""
+    data = _load_json_response(response)
+
+    if isinstance(data, dict):
+        return data
+    if isinstance(data, list):
+        return {"extracted_data": data}
+    return {"extracted_data": [{"content": response, "metadata": {"location": "unknown", "context": "full text"}}]}
+
+@functools.lru_cache(maxsize=32)
 def generate_extraction_prompt(user_prompt: str) -> str:
     """Generate a system message for the extraction task."""
     return f"""You are a web content extraction assistant. Your task is to:
@@ -64,67 +118,262 @@ Important:
 - Use consistent field names across all instances
 - If a field is not found, use "N/A" instead of leaving it empty"""
 
-def scrape_urls(unique_names: List[str], extraction_prompts: List[str], selected_model: str) -> tuple[int, int, float, List[Dict[str, Any]]]:
+@functools.lru_cache(maxsize=32)
+def generate_batch_extraction_prompt(user_prompt: str) -> str:
+    """Generate a system message for extracting from several pages in one call."""
+    return f"""You are a web content extraction assistant. The provided content contains several
+webpages, each one starting with a header line of the form "### DOC <id> URL=<url>". Your task is to:
+
+1. Analyze each webpage separately
+2. {user_prompt}
+3. Extract ALL instances of the requested information from each webpage
+4. For each instance found, extract ALL the fields specified in the prompt
+5. Return the extracted information in a structured JSON format that can be easily converted to CSV
+6. If no relevant information is found in a webpage, return an empty array for it
+
+Format your response as a single JSON object with one entry per DOC id:
+{{
+    "documents": [
+        {{
+            "doc_id": 1,
+            "extracted_data": [
+                {{
+                    "field1": "value1",
+                    "field2": "value2",
+                    ...
+                }},
+                ...
+            ]
+        }},
+        {{
+            "doc_id": 2,
+            "extracted_data": [...]
+        }},
+        ...
+    ]
+}}
+
+Important:
+- Return one entry for EVERY DOC id, in the same order
+- Never mix data from different webpages in the same entry
+- Include ALL fields mentioned in the prompt for each instance
+- Make sure each instance has the same fields/structure
+- Use consistent field names across all instances and webpages
+- If a field is not found, use "N/A" instead of leaving it empty"""
+
+def chunk_markdowns(jobs: List[tuple], model: str, batch_size: int) -> List[List[tuple]]:
+    """
+    Pack (unique_name, content, url) jobs into batches of at most batch_size
+    pages whose combined markdown fits in the model's input token budget
+    (leaving BATCH_RESPONSE_TOKENS for the answer).
+    With batch_size 1 every page is its own batch and nothing is counted.
+    """
+    if batch_size <= 1:
+        return [[job] for job in jobs]
+
+    max_tokens = get_input_token_budget(model, BATCH_RESPONSE_TOKENS)
+    batches = []
+    current = []
+    current_tokens = 0
+    for job in jobs:
+        tokens = token_counter(model=model, text=job[1])
+        if current and (len(current) >= batch_size or current_tokens + tokens > max_tokens):
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append(job)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+def build_batch_content(batch: List[tuple]) -> str:
+    """Concatenate the pages of a batch, each under its "### DOC <id> URL=<url>" header."""
+    return "".join(
+        f"### DOC {doc_id} URL={url}\n{content}\n"
+        for doc_id, (_, content, url) in enumerate(batch, start=1)
+    )
+
+def split_batch_response(batch: List[tuple], parsed: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+    """
+    Fan a parsed batch response out to one {"extracted_data": [...]} per page,
+    in batch order. Pages the model skipped get an empty list.
+    Returns None when the response doesn't follow the "documents" format
+    (wrapper dropped, answer cut short...), since its records can't be
+    attributed to a page.
+    """
+    documents = parsed.get("documents")
+    if not isinstance(documents, list):
+        return None
+
+    per_doc = {}
+    for document in documents:
+        if isinstance(document, dict):
+            per_doc[str(document.get("doc_id"))] = document.get("extracted_data", [])
+    return [{"extracted_data": per_doc.get(str(doc_id), [])} for doc_id in range(1, len(batch) + 1)]
+
+# Bumped when cached responses can no longer be trusted (v2: streamed top-level
+# arrays used to be cut after their first element)
+_LLM_CACHE_VERSION = "2"
+
+def _llm_cache_key(model: str, system_message: str, content: str) -> str:
+    digest = hashlib.blake2b(digest_size=32)
+    for part in (_LLM_CACHE_VERSION, model, system_message, content):
+        digest.update(part.encode())
+        digest.update(b"|")
+    return digest.hexdigest()
+
+def _cached_extraction_call(content: str, model: str, system_message: str, api_key: str = None):
+    """
+    call_llm_model_with_retry() behind llm_cache.
+    Returns (response, token_counts, cost, cache_hit); hits cost nothing.
+    Only responses that parse to a JSON object or array are cached, so a
+    truncated or malformed answer is asked again on the next run.
+    """
+    key = _llm_cache_key(model, system_message, content)
+    cached = llm_cache.get(key)
+    if cached is not None:
+        return cached[0], {"input_tokens": 0, "output_tokens": 0}, 0, True
+
+    result = call_llm_model_with_retry(
+        content,
+        None,  # No Pydantic model needed for prompt-based extraction
+        model,
+        system_message,
+        stream=True,  # stop reading as soon as the JSON object is complete
+        api_key=api_key
+    )
+    response = result[0]
+    if isinstance(response, dict) or isinstance(_load_json_response(response or ""), (dict, list)):
+        llm_cache.set(key, result)
+    return (*result, False)
+
+async def scrape_urls_stream(db, unique_names: List[str], extraction_prompts: List[str], selected_model: str, batch_size: int = 1, raw_rows: Optional[Dict[str, dict]] = None, semaphore: Optional[asyncio.Semaphore] = None) -> AsyncIterator[tuple[Dict[str, Any], int, int, float]]:
     """
     For each unique_name:
-      1) read raw_data from supabase
-      2) extract content based on the prompt using selected LLM
-      3) save formatted_data
-      4) accumulate cost
-    Return total usage + list of extracted data
+      1) read raw_data from supabase, unless the caller already did (raw_rows)
+      2) extract content based on the prompt using selected LLM,
+         up to MAX_CONCURRENT_LLM_CALLS requests in flight (pass semaphore
+         to share that limit with other steps using the same provider key)
+         (responses already in llm_cache are reused).
+         With batch_size > 1, up to batch_size pages share one request
+         (see chunk_markdowns) and the answer is split back per page;
+         pages of an answer that can't be split are asked again one by one
+      3) save formatted_data through db (the run's async supabase client),
+         SUPABASE_BATCH_SIZE rows per request, while other calls are still running
+      4) yield (result, input_tokens, output_tokens, cost) as soon as the
+         page is done, in completion order; a batch's usage is reported
+         on its first page. Usage that no page could take (a discarded
+         batch answer whose single-page retries all failed) is yielded
+         last with result None
     """
-    total_input_tokens = 0
-    total_output_tokens = 0
-    total_cost = 0
-    extraction_results = []
+    pending_rows = []
+    write_tasks = []
+    cache_hits = 0
 
     # Use the first prompt if multiple are provided (though we expect just one)
     extraction_prompt = extraction_prompts[0] if extraction_prompts else "Extract all relevant information from the webpage"
     system_message = generate_extraction_prompt(extraction_prompt)
+    batch_system_message = generate_batch_extraction_prompt(extraction_prompt)
 
-    for uniq in unique_names:
-        raw_data = read_raw_data(uniq)
+    # Fetch every row up front instead of one SELECT per unique_name
+    if raw_rows is None:
+        raw_rows = await read_raw_data_many_async(db, unique_names)
+
+    jobs = []
+    for uniq in dict.fromkeys(unique_names):  # one upsert row per unique_name
+        raw_data = raw_rows.get(uniq)
         if not raw_data or not raw_data.get("content"):
-            BLUE = "\033[34m"
-            RESET = "\033[0m"
-            print(f"{BLUE}No raw_data found for {uniq}, skipping.{RESET}")
+            logger.info("No raw_data found for %s, skipping.", uniq)
             continue
+        jobs.append((uniq, raw_data["content"], raw_data.get("url", "")))
 
-        content = raw_data["content"]
-        url = raw_data.get("url", "")
+    api_key = get_api_key(selected_model)
 
-        # Call LLM with the extraction prompt
-        try:
-            extracted_data, token_counts, cost = call_llm_model(
-                content, 
-                None,  # No Pydantic model needed for prompt-based extraction
-                selected_model,
-                system_message
-            )
-
-            # Try to parse the response if it's a string
-            if isinstance(extracted_data, str):
-                try:
-                    extracted_data = json.loads(extracted_data)
-                except json.JSONDecodeError:
-                    extracted_data = {"extracted_data": [{"content": extracted_data, "metadata": {"location": "unknown", "context": "full text"}}]}
-
-            # Store the results
-            save_formatted_data(uniq, extracted_data)
-
-            # Update totals
-            total_input_tokens += token_counts["input_tokens"]
-            total_output_tokens += token_counts["output_tokens"]
-            total_cost += cost
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_LLM_CALLS)
 
-            # Add to results
-            extraction_results.append({
-                "unique_name": uniq,
-                "url": url,
-                "extracted_data": extracted_data
-            })
-        except Exception as e:
-            print(f"Error processing {uniq}: {str(e)}")
-            continue
+    async def extract(batch):
+        if len(batch) == 1:
+            content, message = batch[0][1], system_message
+        else:
+            content, message = build_batch_content(batch), batch_system_message
+        async with semaphore:
+            try:
+                return batch, await asyncio.to_thread(_cached_extraction_call, content, selected_model, message, api_key)
+            except Exception as e:
+                logger.error("Error processing %s: %s", ", ".join(uniq for uniq, _, _ in batch), e)
+                return batch, None
 
+    # The LLM calls are independent and network-bound, so run them concurrently
+    batches = chunk_markdowns(jobs, selected_model, batch_size)
+    running = {asyncio.ensure_future(extract(batch)) for batch in batches}
+    # usage of batch calls whose answer was discarded, reported with the next page
+    unattributed = (0, 0, 0)
+    while running:
+        done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            batch, result = task.result()
+            if result is None:
+                continue
+            response, token_counts, cost, cache_hit = result
+            usage = (token_counts["input_tokens"], token_counts["output_tokens"], cost)
+
+            parsed = parse_extraction_response(response)
+            per_page = [parsed] if len(batch) == 1 else split_batch_response(batch, parsed)
+            if per_page is None:
+                # Never give every page the whole answer: ask for each page on its own
+                logger.warning("Batch answer for %s can't be split per page, retrying one page at a time", ", ".join(uniq for uniq, _, _ in batch))
+                unattributed = tuple(a + b for a, b in zip(unattributed, usage))
+                running.update(asyncio.ensure_future(extract([job])) for job in batch)
+                continue
+
+            cache_hits += cache_hit * len(batch)
+            usage = tuple(a + b for a, b in zip(unattributed, usage))
+            unattributed = (0, 0, 0)
+            for (uniq, _, url), extracted_data in zip(batch, per_page):
+                # Queue the results; full batches are written in the background
+                pending_rows.append({"unique_name": uniq, "formatted_data": extracted_data})
+                if len(pending_rows) >= SUPABASE_BATCH_SIZE:
+                    write_tasks.append(asyncio.create_task(save_formatted_data_batch_async(db, pending_rows)))
+                    pending_rows = []
+
+                yield {"unique_name": uniq, "url": url, "extracted_data": extracted_data}, *usage
+                usage = (0, 0, 0)
+
+    if any(unattributed):
+        # every retry of a discarded batch failed: the batch call was still paid for
+        yield None, *unattributed
+
+    write_tasks.append(asyncio.create_task(save_formatted_data_batch_async(db, pending_rows)))
+    await asyncio.gather(*write_tasks)
+    if jobs:
+        logger.info("LLM cache hits %d/%d (%.0f%%)", cache_hits, len(jobs), 100 * cache_hits / len(jobs))
+
+async def scrape_urls_async(unique_names: List[str], extraction_prompts: List[str], selected_model: str, batch_size: int = 1) -> tuple[int, int, float, List[Dict[str, Any]]]:
+    """
+    Run scrape_urls_stream() to the end.
+    Return total usage + list of extracted data, in input order.
+    """
+    total_input_tokens = 0
+    total_output_tokens = 0
+    total_cost = 0
+    results_by_name = {}
+
+    async with async_supabase_client() as db:
+        async for result, input_tokens, output_tokens, cost in scrape_urls_stream(db, unique_names, extraction_prompts, selected_model, batch_size):
+            if result is not None:
+                results_by_name[result["unique_name"]] = result
+            total_input_tokens += input_tokens
+            total_output_tokens += output_tokens
+            total_cost += cost
+
+    # Keep the input order, whatever order the calls finished in
+    extraction_results = [results_by_name[uniq] for uniq in dict.fromkeys(unique_names) if uniq in results_by_name]
     return total_input_tokens, total_output_tokens, total_cost, extraction_results
+
+def scrape_urls(unique_names: List[str], extraction_prompts: List[str], selected_model: str, batch_size: int = 1) -> tuple[int, int, float, List[Dict[str, Any]]]:
+    """
+    Synchronous wrapper around scrape_urls_async().
+    """
+    return asyncio.run(scrape_urls_async(unique_names, extraction_prompts, selected_model, batch_size))
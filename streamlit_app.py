@@ -3,26 +3,56 @@
 import streamlit as st
 from streamlit_tags import st_tags_sidebar
 import pandas as pd
-import json
-import re
+import orjson
+import html
 import sys
 import asyncio
+import logging
+import time
 # ---local imports---
-from scraper import scrape_urls
-from pagination import paginate_urls
-from markdown import fetch_and_store_markdowns
-from assets import MODELS_USED
-from api_management import get_supabase_client
+from scraper import scrape_urls_stream, clean_json_response
+from pagination import paginate_urls_async, try_regex_pagination, save_regex_pagination_async
+from markdown import fetch_and_store_markdowns, find_stored_unique_names, read_raw_data_many_async
+from assets import MODELS_USED, API_KEY_NAMES, MAX_PAGES_PER_LLM_CALL, MAX_CONCURRENT_LLM_CALLS, PREVIEW_ROWS
+from api_management import get_cached_supabase_client, clear_cached_supabase_client, async_supabase_client, MissingUniqueConstraintError, UNIQUE_NAME_MIGRATION
+from utils import configure_logging
 
 # Only use WindowsProactorEventLoopPolicy on Windows
 if sys.platform.startswith("win"):
     asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
-
-
+else:
+    # uvloop is optional: a faster event loop when it is installed
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+
+
+
+configure_logging()
+logger = logging.getLogger(__name__)
+
+# One styled "bubble" per added URL; the style is sent once, not per bubble
+BUBBLE_STYLE = (
+    "<style>.url-bubble{"
+    "background-color: #E6F9F3;"  # Very Light Mint for contrast
+    "color: #0074D9;"            # Bright Blue for link-like appearance
+    "border-radius: 15px;"       # Slightly larger radius for smoother edges
+    "padding: 8px 12px;"         # Increased padding for better spacing
+    "margin: 5px;"               # Space between bubbles
+    "display: inline-block;"     # Ensures proper alignment
+    "text-decoration: none;"     # Removes underline if URLs are clickable
+    "font-weight: bold;"         # Makes text stand out
+    "font-family: Arial, sans-serif;"  # Clean and modern font
+    "box-shadow: 0 2px 4px rgba(0, 0, 0, 0.1);"  # Subtle shadow for depth
+    "}</style>"
+)
+BUBBLE_TEMPLATE = "<span class='url-bubble'>{}</span>"
 
 # Initialize Streamlit app
 st.set_page_config(page_title="Universal Web Scraper", page_icon="🦑")
-supabase=get_supabase_client()
+supabase=get_cached_supabase_client()
 if supabase==None:
     st.error("🚨 **Supabase is not configured!** This project requires a Supabase database to function.")
     st.warning("Follow these steps to set it up:")
@@ -35,7 +65,7 @@ if supabase==None:
     ```sql
     CREATE TABLE IF NOT EXISTS scraped_data (
     id BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
-    unique_name TEXT NOT NULL,
+    unique_name TEXT NOT NULL UNIQUE,
     url TEXT,
     raw_data JSONB,        
     formatted_data JSONB, 
@@ -80,13 +110,15 @@ st.sidebar.title("Web Scraper Settings")
 
 # API Keys
 with st.sidebar.expander("API Keys", expanded=False):
-    # Loop over every model in MODELS_USED
-    for model, required_keys in MODELS_USED.items():
-        # required_keys is a set (e.g. {"GEMINI_API_KEY"})
-        for key_name in required_keys:
-            # Create a password-type text input for each API key
+    # A form only reruns the script on submit, not on every keystroke
+    with st.form("api_keys_form", clear_on_submit=False):
+        # One password-type text input per API key (e.g. "GEMINI_API_KEY")
+        for key_name in API_KEY_NAMES:
             st.text_input(key_name,type="password",key=key_name)
-    st.session_state['SUPABASE_ANON_KEY'] = st.text_input("SUPABASE ANON KEY", type="password")
+        st.session_state['SUPABASE_ANON_KEY'] = st.text_input("SUPABASE ANON KEY", type="password")
+        st.form_submit_button("Save keys")
+    # Every supabase read/write goes through the cached client; rebuild it if it went stale
+    st.button("Reconnect to Supabase", on_click=clear_cached_supabase_client)
 
 # Model selection
 model_selection = st.sidebar.selectbox(
@@ -101,48 +133,44 @@ st.sidebar.write("## URL Input Section")
 if "urls_splitted" not in st.session_state:
     st.session_state["urls_splitted"] = []
 
+def _add_urls():
+    """
+    on_click callback for "Add URLs": it runs before the rerun, so the text
+    area can still be cleared through its session_state key.
+    """
+    url_text = st.session_state["url_text_input"]
+    if url_text.strip():
+        new_urls = url_text.split()
+        # dict.fromkeys drops repeats in one pass while keeping the order
+        combined = st.session_state["urls_splitted"] + new_urls
+        st.session_state["urls_splitted"] = list(dict.fromkeys(combined))
+        st.session_state["duplicate_urls_ignored"] = len(combined) - len(st.session_state["urls_splitted"])
+        st.session_state["url_text_input"] = ""
+
+def _clear_urls():
+    st.session_state["urls_splitted"] = []
+    st.session_state["duplicate_urls_ignored"] = 0
+
 with st.sidebar.container():
     col1, col2 = st.columns([3, 1], gap="small")
     
     with col1:
         # A text area to paste multiple URLs at once
-        if "text_temp" not in st.session_state:
-            st.session_state["text_temp"] = ""
-
-        url_text = st.text_area("Enter one or more URLs (space/tab/newline separated):",st.session_state["text_temp"], key="url_text_input", height=68)
+        st.text_area("Enter one or more URLs (space/tab/newline separated):", key="url_text_input", height=68)
 
     with col2:
-        if st.button("Add URLs"):
-            if url_text.strip():
-                new_urls = re.split(r"\s+", url_text.strip())
-                new_urls = [u for u in new_urls if u]
-                st.session_state["urls_splitted"].extend(new_urls)
-                st.session_state["text_temp"] = ""
-                st.rerun()
-        if st.button("Clear URLs"):
-            st.session_state["urls_splitted"] = []
-            st.rerun()
+        st.button("Add URLs", on_click=_add_urls)
+        st.button("Clear URLs", on_click=_clear_urls)
 
     # Show the URLs in an expander, each as a styled "bubble"
     with st.expander("Added URLs", expanded=True):
         if st.session_state["urls_splitted"]:
-            bubble_html = ""
-            for url in st.session_state["urls_splitted"]:
-                bubble_html += (
-                    f"<span style='"
-                    f"background-color: #E6F9F3;"  # Very Light Mint for contrast
-                    f"color: #0074D9;"            # Bright Blue for link-like appearance
-                    f"border-radius: 15px;"       # Slightly larger radius for smoother edges
-                    f"padding: 8px 12px;"         # Increased padding for better spacing
-                    f"margin: 5px;"               # Space between bubbles
-                    f"display: inline-block;"     # Ensures proper alignment
-                    f"text-decoration: none;"     # Removes underline if URLs are clickable
-                    f"font-weight: bold;"         # Makes text stand out
-                    f"font-family: Arial, sans-serif;"  # Clean and modern font
-                    f"box-shadow: 0 2px 4px rgba(0, 0, 0, 0.1);'"  # Subtle shadow for depth
-                    f">{url}</span>"
-                )
+            # URLs are user input rendered as raw HTML, so escape them
+            # Streamlit drops anything not re-rendered, so the style goes out on every rerun
+            bubble_html = BUBBLE_STYLE + "".join(BUBBLE_TEMPLATE.format(html.escape(url)) for url in st.session_state["urls_splitted"])
             st.markdown(bubble_html, unsafe_allow_html=True)
+            if st.session_state.get("duplicate_urls_ignored"):
+                st.caption(f"{st.session_state['duplicate_urls_ignored']} duplicate URLs ignored")
         else:
             st.write("No URLs added yet.")
 
@@ -151,12 +179,20 @@ st.sidebar.markdown("---")
 # Extraction prompt
 show_extraction = st.sidebar.toggle("Enable Extraction")
 extraction_prompt = ""
+batch_size = 1
 if show_extraction:
     extraction_prompt = st.sidebar.text_area(
         'Enter your extraction prompt:',
         placeholder="Example: Extract all advertisements from the webpage, including their titles, descriptions, prices, and any relevant metadata.",
         help="Describe in detail what information you want to extract from the webpages."
     )
+    batch_size = st.sidebar.slider(
+        "Pages per LLM call",
+        min_value=1,
+        max_value=MAX_PAGES_PER_LLM_CALL,
+        value=1,
+        help="Send several pages in a single request to share the prompt and save tokens. Higher values are cheaper but can be less accurate."
+    )
 
 st.sidebar.markdown("---")
 
@@ -167,6 +203,34 @@ if use_pagination:
 
 st.sidebar.markdown("---")
 
+force_refresh = st.sidebar.checkbox("Force refresh", help="Fetch the pages again instead of reusing the ones fetched for the same URLs during the last hour")
+
+# Seconds a fetched URL set is reused by the same session
+FETCH_CACHE_TTL = 3600
+
+def _cached_fetch_markdowns(urls_tuple: tuple[str, ...]) -> list[str]:
+    """
+    fetch_and_store_markdowns() behind a per-session cache, so that two
+    users launching the same URLs never share (and overwrite) the same
+    unique_names. A URL set is only cached when every page was stored with
+    content; failed crawls are fetched again on the next LAUNCH.
+    """
+    cache = st.session_state.setdefault("fetched_markdowns", {})
+    cached = cache.get(urls_tuple)
+    if cached and time.monotonic() - cached[0] < FETCH_CACHE_TTL:
+        return cached[1]
+
+    # The whole URL list goes in one call: pages are crawled concurrently and
+    # stored with one upsert per SUPABASE_BATCH_SIZE rows, not one per URL
+    unique_names = fetch_and_store_markdowns(list(urls_tuple))
+    if len(find_stored_unique_names(unique_names)) == len(set(unique_names)):
+        cache[urls_tuple] = (time.monotonic(), unique_names)
+    return unique_names
+
+def _show_missing_unique_constraint():
+    st.error("Your scraped_data table is missing the UNIQUE constraint on unique_name. Run this once in the Supabase SQL Editor, then launch again:")
+    st.code(UNIQUE_NAME_MIGRATION, language="sql")
+
 # Main action button
 if st.sidebar.button("LAUNCH", type="primary"):
     if st.session_state["urls_splitted"] == []:
@@ -175,18 +239,159 @@ if st.sidebar.button("LAUNCH", type="primary"):
         st.error("Please enter an extraction prompt.")
     else:
         # Save user choices
+        st.session_state["urls_splitted"] = list(dict.fromkeys(st.session_state["urls_splitted"]))
         st.session_state['urls'] = st.session_state["urls_splitted"]
         st.session_state['extraction_prompt'] = extraction_prompt
+        st.session_state['batch_size'] = batch_size
         st.session_state['model_selection'] = model_selection
         st.session_state['use_pagination'] = use_pagination
         st.session_state['pagination_details'] = pagination_details
+        # With no user instructions, URLs carrying their page number skip the LLM
+        use_regex = use_pagination and not pagination_details.strip()
+        st.session_state['regex_pagination'] = try_regex_pagination(st.session_state["urls_splitted"]) if use_regex else None
         
-        # fetch or reuse the markdown for each URL
-        unique_names = fetch_and_store_markdowns(st.session_state["urls_splitted"])
-        st.session_state["unique_names"] = unique_names
-
-        # Move on to "scraping" step
-        st.session_state['scraping_state'] = 'scraping'
+        # fetch or reuse the markdown for each URL; the cache key is sorted so
+        # the same set of URLs in another order is still a hit
+        if force_refresh:
+            st.session_state.pop("fetched_markdowns", None)
+        sorted_urls = tuple(sorted(set(st.session_state["urls_splitted"])))
+        try:
+            names_by_url = dict(zip(sorted_urls, _cached_fetch_markdowns(sorted_urls)))
+        except MissingUniqueConstraintError:
+            _show_missing_unique_constraint()
+        else:
+            unique_names = [names_by_url[url] for url in st.session_state["urls_splitted"]]
+            st.session_state["unique_names"] = unique_names
+
+            # Move on to "scraping" step
+            st.session_state['scraping_state'] = 'scraping'
+
+@st.cache_data(show_spinner=False)
+def _df_to_csv(df: pd.DataFrame) -> bytes:
+    return df.to_csv(index=False).encode("utf-8")
+
+@st.cache_data(show_spinner=False)
+def _df_to_json(df: pd.DataFrame) -> bytes:
+    return df.to_json(orient="records").encode("utf-8")
+
+def _expand_item(item):
+    """
+    Return the records held by one extracted item.
+    Raw LLM text that scrape_urls could not parse is cleaned and parsed here;
+    an item that is already a record is returned as is.
+    """
+    if set(item) != {'content', 'metadata'}:
+        return [item]
+    try:
+        # Remove any markdown fences and surrounding text
+        parsed = orjson.loads(clean_json_response(item['content']))
+        return [i for i in parsed['extracted_data'] if isinstance(i, dict)]
+    except (orjson.JSONDecodeError, KeyError, TypeError) as e:
+        logger.debug("Error parsing raw extraction %r: %s", item['content'], e)
+        return []
+
+def _append_columns(columns, all_data):
+    """
+    Add one row per extracted record to columns, a dict of per-column lists
+    seeded with 'Source URL' so that it stays the first column.
+    Keys missing from a record are padded with None so every list keeps
+    the same length, and pd.DataFrame(columns) needs no row-to-column pivot.
+    """
+    row_count = len(columns['Source URL'])
+    for url_data in all_data:
+        extracted = url_data.get('extracted_data')
+        if not isinstance(extracted, dict):
+            continue
+        url = url_data.get('url', 'N/A')
+        for item in extracted.get('extracted_data', []):
+            if not isinstance(item, dict):
+                continue
+            for record in _expand_item(item):
+                for key, value in record.items():
+                    if key == 'Source URL':
+                        continue
+                    column = columns.setdefault(key, [])
+                    column.extend([None] * (row_count - len(column)))
+                    column.append(value)
+                columns['Source URL'].append(url)
+                row_count += 1
+    for column in columns.values():
+        column.extend([None] * (row_count - len(column)))
+    return columns
+
+async def _stream_extraction(db, unique_names, preview, progress, raw_rows, semaphore):
+    """
+    Consume scrape_urls_stream(), showing each URL's rows in the preview
+    placeholder and advancing the progress bar as soon as the URL is done.
+    Returns the same (in_tokens, out_tokens, cost, data) as scrape_urls_async.
+    """
+    total_input_tokens = 0
+    total_output_tokens = 0
+    total_cost = 0
+    results_by_name = {}
+    columns = {'Source URL': []}
+    total = len(set(unique_names))
+
+    async for result, input_tokens, output_tokens, cost in scrape_urls_stream(
+        db,
+        unique_names,
+        [st.session_state['extraction_prompt']],  # Pass the prompt as a single field
+        st.session_state['model_selection'],
+        st.session_state['batch_size'],
+        raw_rows=raw_rows,
+        semaphore=semaphore
+    ):
+        total_input_tokens += input_tokens
+        total_output_tokens += output_tokens
+        total_cost += cost
+        if result is None:
+            continue  # usage only (see scrape_urls_stream)
+        results_by_name[result['unique_name']] = result
+
+        _append_columns(columns, [result])
+        progress.progress(len(results_by_name) / total, text=f"Extracted {len(results_by_name)}/{total} URLs")
+        if columns['Source URL']:
+            preview.dataframe(pd.DataFrame(columns), use_container_width=True, hide_index=True)
+
+    # Keep the input order, whatever order the calls finished in
+    data = [results_by_name[uniq] for uniq in dict.fromkeys(unique_names) if uniq in results_by_name]
+    return total_input_tokens, total_output_tokens, total_cost, data
+
+async def _run_pipeline(unique_names, preview, progress):
+    """
+    Run extraction and pagination concurrently; both are network-bound LLM work.
+    Both steps share one async supabase client (closed when they are done),
+    one read of the pages' raw_data and one LLM concurrency limit, since
+    they call the same provider with the same key.
+    Returns (scrape_result, pagination_result); a disabled step gives None.
+    """
+    async def disabled():
+        return None
+
+    async with async_supabase_client() as db:
+        llm_pagination = st.session_state['use_pagination'] and st.session_state['regex_pagination'] is None
+        raw_rows = await read_raw_data_many_async(db, unique_names) if show_extraction or llm_pagination else {}
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_LLM_CALLS)
+        scrape_task = asyncio.create_task(
+            _stream_extraction(db, unique_names, preview, progress, raw_rows, semaphore) if show_extraction else disabled()
+        )
+        if not st.session_state['use_pagination']:
+            pagination = disabled()
+        elif st.session_state['regex_pagination'] is not None:
+            # every URL carries its page number: no LLM call needed
+            pagination = save_regex_pagination_async(db, unique_names, st.session_state['regex_pagination'])
+        else:
+            pagination = paginate_urls_async(
+                db,
+                unique_names,
+                st.session_state['model_selection'],
+                st.session_state['pagination_details'],
+                st.session_state["urls_splitted"],
+                raw_rows=raw_rows,
+                semaphore=semaphore
+            )
+        pagination_task = asyncio.create_task(pagination)
+        return await asyncio.gather(scrape_task, pagination_task)
 
 if st.session_state['scraping_state'] == 'scraping':
     try:
@@ -196,52 +401,53 @@ if st.session_state['scraping_state'] == 'scraping':
             total_input_tokens = 0
             total_output_tokens = 0
             total_cost = 0
+
+            # Rows show up here while the remaining URLs are still being extracted
+            progress = st.progress(0.0) if show_extraction else st.empty()
+            preview = st.empty()
+            scrape_result, pagination_result = asyncio.run(_run_pipeline(unique_names, preview, progress))
+            # The full results are rendered below
+            progress.empty()
+            preview.empty()
             
-            # 1) Scraping logic
+            # 1) Scraping results
             all_data = []
-            if show_extraction:
-                in_tokens_s, out_tokens_s, cost_s, parsed_data = scrape_urls(
-                    unique_names,
-                    [st.session_state['extraction_prompt']],  # Pass the prompt as a single field
-                    st.session_state['model_selection']
-                )
+            if scrape_result is not None:
+                in_tokens_s, out_tokens_s, cost_s, parsed_data = scrape_result
                 total_input_tokens += in_tokens_s
                 total_output_tokens += out_tokens_s
                 total_cost += cost_s
 
                 # Store or display parsed data 
                 all_data = parsed_data
-                st.session_state['in_tokens_s'] = in_tokens_s
-                st.session_state['out_tokens_s'] = out_tokens_s
-                st.session_state['cost_s'] = cost_s
 
-            # 2) Pagination logic
+            # 2) Pagination results
             pagination_info = None
-            if st.session_state['use_pagination']:
-                in_tokens_p, out_tokens_p, cost_p, page_results = paginate_urls(
-                    unique_names,
-                    st.session_state['model_selection'],
-                    st.session_state['pagination_details'],
-                    st.session_state["urls_splitted"]
-                )
+            if pagination_result is not None:
+                in_tokens_p, out_tokens_p, cost_p, page_results = pagination_result
                 total_input_tokens += in_tokens_p
                 total_output_tokens += out_tokens_p
                 total_cost += cost_p
 
                 pagination_info = page_results
-                st.session_state['in_tokens_p'] = in_tokens_p
-                st.session_state['out_tokens_p'] = out_tokens_p
-                st.session_state['cost_p'] = cost_p
 
             # 3) Save everything in session state
+            st.session_state['totals'] = {
+                'in': total_input_tokens,
+                'out': total_output_tokens,
+                'cost': total_cost,
+                # formatted once here instead of on every rerun
+                'formatted': (f"{total_input_tokens:,}", f"{total_output_tokens:,}", f"${total_cost:.4f}")
+            }
             st.session_state['results'] = {
                 'data': all_data,
-                'input_tokens': total_input_tokens,
-                'output_tokens': total_output_tokens,
-                'total_cost': total_cost,
-                'pagination_info': pagination_info
+                'pagination_info': pagination_info,
+                'regex_pagination': st.session_state['regex_pagination'] is not None
             }
             st.session_state['scraping_state'] = 'completed'
+    except MissingUniqueConstraintError:
+        _show_missing_unique_constraint()
+        st.session_state['scraping_state'] = 'idle'
     except Exception as e:
         st.error(f"An error occurred during scraping: {e}")
         st.session_state['scraping_state'] = 'idle'
@@ -250,9 +456,6 @@ if st.session_state['scraping_state'] == 'scraping':
 if st.session_state['scraping_state'] == 'completed' and st.session_state['results']:
     results = st.session_state['results']
     all_data = results['data']
-    total_input_tokens = results['input_tokens']
-    total_output_tokens = results['output_tokens']
-    total_cost = results['total_cost']
     pagination_info = results['pagination_info']
 
     if show_extraction:
@@ -260,63 +463,20 @@ if st.session_state['scraping_state'] == 'completed' and st.session_state['resul
         
         # Display the results in a more structured way
         if all_data:
-            # Convert the data to a DataFrame for better display
-            processed_data = []
-            for url_data in all_data:
-                url = url_data.get('url', 'N/A')
-                extracted = url_data.get('extracted_data', {})
-                print("extracted",extracted)
-                
-                # Handle the nested structure where extracted_data is inside another extracted_data key
-                if isinstance(extracted, dict):
-                    # Get the inner extracted_data array
-                    items = extracted.get('extracted_data', [])
-                    print("items",items)
-                    if isinstance(items, list):
-                        for item in items:
-                            try:
-                                # Clean and parse the JSON content
-                                if isinstance(item, dict) and 'content' in item:
-                                    # Remove any leading/trailing whitespace and quotes
-                                    json_str = item['content']
-                                    cleaned_content = json_str.strip().removeprefix("```json").removesuffix("```").strip()
-                                    print("cleaned_content",json_str)
-                                    parsed_data = json.loads(cleaned_content)['extracted_data']  
-                               
-                                    for i in parsed_data:
-                                    # Create row from parsed data
-                                        print("data ",i)
-
-                                        row = {'Source URL': url}
-                                        if isinstance(i, dict):
-                                            for key, value in i.items():
-                                                row[key] = value
-                                        processed_data.append(row)
-                                        
-                            except json.JSONDecodeError as e:
-                                print(f"Error parsing JSON: {e}")
-                                continue
-                            except Exception as e:
-                                print(f"Error processing item: {e}")
-                                continue
-                
-            if processed_data:
-                # Dynamically create DataFrame from processed data
-                df = pd.DataFrame(processed_data)
-
-                # Optional: move 'Source URL' to the front if it exists
-                if 'Source URL' in df.columns:
-                    cols = ['Source URL'] + [col for col in df.columns if col != 'Source URL']
-                    df = df[cols]
+            # Build the table column by column in a single pass over the data
+            columns = _append_columns({'Source URL': []}, all_data)
+            logger.debug("%d records extracted from %d URLs", len(columns['Source URL']), len(all_data))
+
+            if columns['Source URL']:
+                df = pd.DataFrame(columns)
                 
                 # Create download buttons in a more prominent location
                 st.markdown("### Download Options")
                 col1, col2 = st.columns(2)
                 with col1:
-                    csv_data = df.to_csv(index=False)
                     st.download_button(
                         "📥 Download as CSV",
-                        csv_data,
+                        _df_to_csv(df),
                         "scraped_data.csv",
                         "text/csv",
                         key='download-csv',
@@ -325,7 +485,7 @@ if st.session_state['scraping_state'] == 'completed' and st.session_state['resul
                 with col2:
                     st.download_button(
                         "📥 Download as JSON",
-                        df.to_json(orient="records"),
+                        _df_to_json(df),
                         "scraped_data.json",
                         "application/json",
                         key='download-json',
@@ -334,11 +494,18 @@ if st.session_state['scraping_state'] == 'completed' and st.session_state['resul
                 
                 # Display the data in a table format with improved visibility
                 st.markdown("### Data Preview")
+                # Only one page of rows is sent to the browser; the downloads hold everything
+                preview_df = df
+                if len(df) > PREVIEW_ROWS:
+                    page = st.number_input("Page", min_value=1, max_value=(len(df) - 1) // PREVIEW_ROWS + 1, value=1)
+                    preview_df = df.iloc[(page - 1) * PREVIEW_ROWS:page * PREVIEW_ROWS]
                 st.dataframe(
-                    df,
+                    preview_df,
                     use_container_width=True,
                     hide_index=True
                 )
+                if len(df) > PREVIEW_ROWS:
+                    st.caption(f"Showing {len(preview_df):,} of {len(df):,} rows — download for full dataset")
                 
                 # Show data statistics
                 st.markdown("### Dataset Statistics")
@@ -352,15 +519,21 @@ if st.session_state['scraping_state'] == 'completed' and st.session_state['resul
 
         # Display token usage and cost information
         st.subheader("Processing Statistics")
+        input_tokens_s, output_tokens_s, cost_s = st.session_state['totals']['formatted']
         col1, col2, col3 = st.columns(3)
         with col1:
-            st.metric("Input Tokens", f"{total_input_tokens:,}")
+            st.metric("Input Tokens", input_tokens_s)
         with col2:
-            st.metric("Output Tokens", f"{total_output_tokens:,}")
+            st.metric("Output Tokens", output_tokens_s)
         with col3:
-            st.metric("Total Cost", f"${total_cost:.4f}")
+            st.metric("Total Cost", cost_s)
 
     if pagination_info:
         st.subheader("Pagination Information")
+        if results.get('regex_pagination'):
+            st.info(
+                "Used cheap regex pagination: only the next page URL was derived from each URL's page number, "
+                "not the full list of pages. Enter pagination details to have the LLM detect every page."
+            )
         st.json(pagination_info)
 
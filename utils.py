@@ -1,5 +1,13 @@
 from datetime import datetime
+import functools
+import hashlib
+import logging
 import re
+from typing import List
+import orjson
+from pydantic import BaseModel
+
+_NON_WORD_RE = re.compile(r'\W+')
 # =============================================================================
 # 6) GENERATE UNIQUE FOLDER NAME
 # =============================================================================
@@ -7,9 +15,90 @@ def generate_unique_name(url: str) -> str:
     """
     Generate a unique name for the folder based on the URL.
     """
+    return generate_unique_names([url])[0]
+
+def generate_unique_names(urls: List[str]) -> List[str]:
+    """
+    Generate unique names for a batch of URLs in one pass.
+    The timestamp is taken once for the batch; a short blake2b digest of
+    each URL keeps names distinct, even for URLs on the same domain.
+    """
     timestamp = datetime.now().strftime('%Y_%m_%d__%H_%M_%S_%f')
-    domain = re.sub(r'\W+', '_', url.split('//')[-1].split('/')[0])
-    return f"{domain}_{timestamp}"
+    names = []
+    for url in urls:
+        domain = _NON_WORD_RE.sub('_', url.split('//')[-1].split('/')[0])
+        digest = hashlib.blake2b(url.encode(), digest_size=4).hexdigest()
+        names.append(f"{domain}_{timestamp}_{digest}")
+    return names
+
+# =============================================================================
+# JSONB PAYLOADS
+# =============================================================================
+@functools.singledispatch
+def to_jsonb(data):
+    """
+    Turn an LLM result into a value for a JSONB column.
+    dicts, lists and other JSON-ready values are passed through untouched
+    (supabase-py serializes them once for the request body).
+    """
+    return data
+
+@to_jsonb.register
+def _(data: str):
+    # Parsed once here; text that isn't JSON is kept under "raw_text"
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        return {"raw_text": data}
+
+@to_jsonb.register
+def _(data: BaseModel):
+    return data.model_dump()
+
+# =============================================================================
+# LOGGING
+# =============================================================================
+# Modules whose INFO/DEBUG output we want; third-party loggers stay at WARNING
+APP_LOGGERS = ("__main__", "markdown", "scraper", "pagination", "llm_calls")
+
+class ColorFormatter(logging.Formatter):
+    """
+    Formatter that colors each line by level, but only when the
+    output stream is a terminal.
+    """
+    COLORS = {
+        logging.DEBUG: "\033[36m",    # cyan
+        logging.INFO: "\033[34m",     # blue
+        logging.WARNING: "\033[33m",  # yellow
+        logging.ERROR: "\033[31m",    # red
+    }
+    RESET = "\033[0m"
+
+    def __init__(self, fmt: str, use_color: bool):
+        super().__init__(fmt)
+        self.use_color = use_color
+
+    def format(self, record: logging.LogRecord) -> str:
+        message = super().format(record)
+        color = self.COLORS.get(record.levelno)
+        if self.use_color and color:
+            return f"{color}{message}{self.RESET}"
+        return message
+
+def configure_logging(level: int = logging.INFO) -> None:
+    """
+    Configure logging once at app startup. Calling it again (e.g. on a
+    Streamlit rerun) is a no-op.
+    """
+    root = logging.getLogger()
+    if root.handlers:
+        return
+    handler = logging.StreamHandler()
+    handler.setFormatter(ColorFormatter("%(levelname)s:%(message)s", use_color=handler.stream.isatty()))
+    root.addHandler(handler)
+    root.setLevel(logging.WARNING)
+    for name in APP_LOGGERS:
+        logging.getLogger(name).setLevel(level)
 
 # def calculate_price(token_counts, model):
 #     """